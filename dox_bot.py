@@ -5,7 +5,14 @@ Dox Image Bot v2.3 STABLE
 """
 
 import os
+import sys
+import time
+import asyncio
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
@@ -29,9 +36,57 @@ DEFAULT_DARKNESS = 60
 DEFAULT_POSITION = "bottom-left"
 DEFAULT_WATERMARK_SIZE = 0.2  # доля ширины картинки (20%)
 
+# Лимит кэша скачанных исходников (байты файла + декодированный RGBA)
+SOURCE_CACHE_MAX_BYTES = int(os.environ.get("SOURCE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# Спекулятивный рендер: сколько вариантов готовить заранее, лимит памяти
+# готовых JPEG и доля CPU, которую фоновый рендер может занимать
+SPECULATIVE_MAX_VARIANTS = int(os.environ.get("SPECULATIVE_MAX_VARIANTS", 3))
+SPECULATIVE_CACHE_MAX_BYTES = int(os.environ.get("SPECULATIVE_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+# Доля CPU ограничена 1; 0 и меньше — спекулятивный рендер выключен
+SPECULATIVE_CPU_SHARE = min(float(os.environ.get("SPECULATIVE_CPU_SHARE", 0.25)), 1.0)
+SPECULATIVE_QUEUE_MAX_USERS = 32  # сколько пользователей ждут фоновый рендер
+
 # Хранилище настроек пользователей
 user_settings = {}
 
+# Блокировки по пользователям: его обновления идут по очереди даже при concurrent_updates
+user_locks = {}
+
+# Общий кэш исходников: file_unique_id → {'bytes', 'image', 'size'} (LRU)
+source_cache = OrderedDict()
+# Скачивания в процессе: file_unique_id → Future (single-flight)
+source_inflight = {}
+source_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'coalesced': 0,
+    'bytes_saved': 0,
+    'bytes_cached': 0,
+}
+
+# Готовые варианты: (file_unique_id, darkness, position, size, logo) → {'data', 'cpu', 'used'} (LRU)
+speculative_cache = OrderedDict()
+# Очередь фонового рендера: user_id → {'image_id', 'logo_digest', 'variants'};
+# новый запрос пользователя заменяет старый
+speculative_queue = OrderedDict()
+# Будит воркер: появилась работа или бот освободился
+speculative_wakeup = asyncio.Event()
+# Единственный фоновый воркер (Task)
+speculative_worker = {'task': None}
+speculative_stats = {
+    'hits': 0,
+    'misses': 0,
+    'rendered': 0,
+    'wasted': 0,
+    'wasted_cpu': 0.0,
+    'bytes_cached': 0,
+}
+# Сколько обработчиков сейчас заняты реальной работой
+render_activity = {'active': 0}
+# Бюджет CPU: следующий фоновый рендер не раньше 'next_allowed' (time.monotonic)
+speculative_budget = {'next_allowed': 0.0}
+
 
 def get_user_settings(user_id):
     """Получить настройки пользователя"""
@@ -41,15 +96,42 @@ def get_user_settings(user_id):
             'position': DEFAULT_POSITION,
             'watermark_size': DEFAULT_WATERMARK_SIZE,
             'last_image': None,
+            'last_image_id': None,  # file_unique_id последнего фото
             'logo': None,  # bytes пользовательского логотипа
-            'waiting_for_logo': False
+            'logo_digest': None,  # sha1 логотипа (ключ кэша вариантов)
+            'waiting_for_logo': False,
+            'history': {'darkness': {}, 'position': {}, 'watermark_size': {}}  # счётчики выборов
         }
     s = user_settings[user_id]
     if 'watermark_size' not in s:
         s['watermark_size'] = DEFAULT_WATERMARK_SIZE
+    if 'history' not in s:
+        s['history'] = {'darkness': {}, 'position': {}, 'watermark_size': {}}
+    if 'logo_digest' not in s:
+        s['logo_digest'] = get_logo_digest(s['logo'])
     return s
 
 
+def get_user_lock(user_id):
+    """Получить блокировку пользователя"""
+    if user_id not in user_locks:
+        user_locks[user_id] = asyncio.Lock()
+    return user_locks[user_id]
+
+
+def get_logo_digest(logo_bytes):
+    """Отпечаток содержимого логотипа (None — дефолтный)"""
+    if not logo_bytes:
+        return None
+    return hashlib.sha1(logo_bytes).hexdigest()
+
+
+def record_choice(settings, kind, value):
+    """Запомнить выбор пользователя (для спекулятивного рендера)"""
+    counts = settings['history'][kind]
+    counts[value] = counts.get(value, 0) + 1
+
+
 def get_user_logo(user_id):
     """Получить логотип пользователя (путь или BytesIO)"""
     settings = get_user_settings(user_id)
@@ -69,22 +151,127 @@ def get_logo_bytes(user_id):
             return f.read()
 
 
-def process_image_with_settings(image_bytes, darkness, position, logo_source, logo_size_fraction=None):
-    """Обработать изображение с заданными настройками"""
-    if logo_size_fraction is None:
-        logo_size_fraction = DEFAULT_WATERMARK_SIZE
-    # Открываем изображение
+def decode_source(image_bytes):
+    """Декодировать исходник в RGBA"""
     img = Image.open(BytesIO(image_bytes))
-    
-    # Конвертируем в RGBA
+    img.load()
     if img.mode != 'RGBA':
         img = img.convert('RGBA')
+    return img
+
+
+def put_source_cache(key, entry):
+    """Положить исходник в кэш, вытесняя самые старые записи"""
+    if entry['size'] > SOURCE_CACHE_MAX_BYTES:
+        return
+    source_cache[key] = entry
+    source_cache_stats['bytes_cached'] += entry['size']
+    while source_cache_stats['bytes_cached'] > SOURCE_CACHE_MAX_BYTES:
+        _, old = source_cache.popitem(last=False)
+        source_cache_stats['bytes_cached'] -= old['size']
+
+
+def log_source_cache_hit(key, entry, kind):
+    """Учесть попадание в кэш исходников"""
+    source_cache_stats[kind] += 1
+    source_cache_stats['bytes_saved'] += len(entry['bytes'])
+    logger.info(
+        f"Кэш исходников: {kind} {key}, сэкономлено {len(entry['bytes'])} байт "
+        f"(hits={source_cache_stats['hits']}, coalesced={source_cache_stats['coalesced']}, "
+        f"misses={source_cache_stats['misses']}, всего сэкономлено {source_cache_stats['bytes_saved']} байт)"
+    )
+
+
+async def download_source(bot, photo):
+    """Скачать и декодировать фото с дедупликацией по file_unique_id"""
+    key = photo.file_unique_id
+    
+    entry = source_cache.get(key)
+    if entry is not None:
+        source_cache.move_to_end(key)
+        log_source_cache_hit(key, entry, 'hits')
+        return entry
+    
+    # Такой же файл уже качается — ждём тот же результат
+    pending = source_inflight.get(key)
+    if pending is not None:
+        entry = await asyncio.shield(pending)
+        log_source_cache_hit(key, entry, 'coalesced')
+        return entry
+    
+    source_cache_stats['misses'] += 1
+    future = asyncio.get_running_loop().create_future()
+    source_inflight[key] = future
+    try:
+        file = await bot.get_file(photo.file_id)
+        image_bytes = bytes(await file.download_as_bytearray())
+        image = decode_source(image_bytes)
+        entry = {
+            'bytes': image_bytes,
+            'image': image,
+            'size': len(image_bytes) + image.width * image.height * 4,
+        }
+        put_source_cache(key, entry)
+        future.set_result(entry)
+        return entry
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # ошибку получат ожидающие, без warning'а asyncio
+        raise
+    finally:
+        # Владелец загрузки отменён — ожидающим отдаём обычную ошибку, а не CancelledError
+        if not future.done():
+            future.set_exception(RuntimeError("Загрузка фото прервана, отправь его ещё раз"))
+            future.exception()
+        source_inflight.pop(key, None)
+
+
+def get_last_source(settings):
+    """Последний исходник пользователя: декодированный из кэша или байты"""
+    entry = source_cache.get(settings.get('last_image_id'))
+    if entry is not None:
+        return entry['image']
+    return settings['last_image']
+
+
+def render_last_image(user_id, settings):
+    """Пересоздать последнее фото пользователя с текущими настройками"""
+    return process_image_with_settings(
+        get_last_source(settings),
+        settings['darkness'],
+        settings['position'],
+        get_user_logo(user_id),
+        logo_size_fraction=settings['watermark_size']
+    )
+
+
+def process_image_with_settings(image_source, darkness, position, logo_source, logo_size_fraction=None):
+    """Обработать изображение с заданными настройками (bytes или декодированный RGBA)"""
+    if logo_size_fraction is None:
+        logo_size_fraction = DEFAULT_WATERMARK_SIZE
+    img = darken_image(image_source, darkness)
+    img = apply_logo(img, position, logo_source, logo_size_fraction)
+    return encode_jpeg(img)
+
+
+def darken_image(image_source, darkness):
+    """Этап 1: открыть исходник и затемнить"""
+    # Открываем изображение (кэшированный исходник не трогаем)
+    if isinstance(image_source, Image.Image):
+        img = image_source.copy()
+    else:
+        img = decode_source(image_source)
     
     # Создаём и накладываем затемняющий слой (если darkness > 0)
     if darkness > 0:
         overlay = Image.new('RGBA', img.size, (0, 0, 0, int(255 * (darkness / 100))))
         img = Image.alpha_composite(img, overlay)
     
+    return img
+
+
+def apply_logo(img, position, logo_source, logo_size_fraction):
+    """Этап 2: отмасштабировать и наложить логотип"""
     # Открываем логотип
     if isinstance(logo_source, str):
         logo = Image.open(logo_source)
@@ -116,6 +303,11 @@ def process_image_with_settings(image_bytes, darkness, position, logo_source, lo
     # Накладываем логотип
     img.paste(logo, logo_position, logo)
     
+    return img
+
+
+def encode_jpeg(img):
+    """Этап 3: сохранить в JPEG"""
     # Конвертируем в RGB для JPEG
     img = img.convert('RGB')
     
@@ -154,6 +346,10 @@ WATERMARK_SIZE_FRACTIONS = {
 }
 
 
+# Уровни затемнения: из них строится клавиатура и ранжирование вариантов
+DARKNESS_LEVELS = [0, 30, 40, 50, 60, 70, 80, 90, 100]
+
+
 def get_watermark_size_label(fraction: float) -> str:
     """Подпись размера ватермарки (процент от ширины)"""
     pct = int(round(fraction * 100))
@@ -199,24 +395,17 @@ def get_logo_menu_keyboard():
 
 def get_darkness_keyboard():
     """Выбор затемнения"""
-    keyboard = [
-        [InlineKeyboardButton("☀️ Без затемнения", callback_data="darkness_0")],
-        [
-            InlineKeyboardButton("30%", callback_data="darkness_30"),
-            InlineKeyboardButton("40%", callback_data="darkness_40"),
-            InlineKeyboardButton("50%", callback_data="darkness_50")
-        ],
-        [
-            InlineKeyboardButton("60%", callback_data="darkness_60"),
-            InlineKeyboardButton("70%", callback_data="darkness_70"),
-            InlineKeyboardButton("80%", callback_data="darkness_80")
-        ],
-        [
-            InlineKeyboardButton("90%", callback_data="darkness_90"),
-            InlineKeyboardButton("100%", callback_data="darkness_100")
-        ],
-        [InlineKeyboardButton("« Назад", callback_data="back_to_main")]
-    ]
+    keyboard = []
+    if 0 in DARKNESS_LEVELS:
+        keyboard.append([InlineKeyboardButton("☀️ Без затемнения", callback_data="darkness_0")])
+    # Остальные уровни — по 3 в ряд
+    levels = [d for d in DARKNESS_LEVELS if d > 0]
+    for i in range(0, len(levels), 3):
+        keyboard.append([
+            InlineKeyboardButton(f"{d}%", callback_data=f"darkness_{d}")
+            for d in levels[i:i + 3]
+        ])
+    keyboard.append([InlineKeyboardButton("« Назад", callback_data="back_to_main")])
     return InlineKeyboardMarkup(keyboard)
 
 
@@ -230,8 +419,239 @@ def get_settings_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
+# ===== СПЕКУЛЯТИВНЫЙ РЕНДЕР =====
+
+def lower_thread_priority():
+    """Понизить приоритет потока фонового рендера (только Linux: nice на поток)"""
+    if not sys.platform.startswith('linux'):
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+
+# Один поток с низким приоритетом — фоновый рендер не займёт больше одного ядра
+speculative_executor = ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix="speculative",
+    initializer=lower_thread_priority
+)
+
+
+def get_variant_key(settings, darkness, position, watermark_size):
+    """Ключ готового варианта в кэше спекулятивного рендера"""
+    return (settings['last_image_id'], darkness, position, watermark_size, settings['logo_digest'])
+
+
+def rank_speculative_variants(settings):
+    """Самые вероятные следующие варианты: соседние значения + история выборов"""
+    history = settings['history']
+    candidates = []
+    
+    # Затемнение: соседние уровни вероятнее остальных
+    if settings['darkness'] in DARKNESS_LEVELS:
+        current = DARKNESS_LEVELS.index(settings['darkness'])
+    else:
+        current = None
+    for i, darkness in enumerate(DARKNESS_LEVELS):
+        if darkness == settings['darkness']:
+            continue
+        score = history['darkness'].get(darkness, 0)
+        if current is not None and abs(i - current) == 1:
+            score += 1
+        candidates.append((score, (darkness, settings['position'], settings['watermark_size'])))
+    
+    for position in POSITION_LABELS:
+        if position == settings['position']:
+            continue
+        score = history['position'].get(position, 0)
+        candidates.append((score, (settings['darkness'], position, settings['watermark_size'])))
+    
+    sizes = list(WATERMARK_SIZE_FRACTIONS.values())
+    if settings['watermark_size'] in sizes:
+        current = sizes.index(settings['watermark_size'])
+    else:
+        current = None
+    for i, size in enumerate(sizes):
+        if size == settings['watermark_size']:
+            continue
+        score = history['watermark_size'].get(size, 0)
+        if current is not None and abs(i - current) == 1:
+            score += 0.5
+        candidates.append((score, (settings['darkness'], settings['position'], size)))
+    
+    # sort стабильный: при равных очках затемнение идёт первым
+    candidates.sort(key=lambda c: c[0], reverse=True)
+    return [variant for _, variant in candidates[:SPECULATIVE_MAX_VARIANTS]]
+
+
+def put_speculative_cache(key, entry):
+    """Положить готовый вариант в кэш; неиспользованные вытесненные — потраченная зря работа"""
+    if len(entry['data']) > SPECULATIVE_CACHE_MAX_BYTES:
+        return
+    speculative_cache[key] = entry
+    speculative_stats['bytes_cached'] += len(entry['data'])
+    while speculative_stats['bytes_cached'] > SPECULATIVE_CACHE_MAX_BYTES:
+        _, old = speculative_cache.popitem(last=False)
+        speculative_stats['bytes_cached'] -= len(old['data'])
+        if not old['used']:
+            speculative_stats['wasted'] += 1
+            speculative_stats['wasted_cpu'] += old['cpu']
+
+
+def log_speculative_stats(event):
+    """Залогировать метрики спекулятивного рендера"""
+    lookups = speculative_stats['hits'] + speculative_stats['misses']
+    hit_rate = speculative_stats['hits'] / lookups if lookups else 0.0
+    logger.info(
+        f"Спекулятивный рендер: {event} (hit rate {hit_rate:.0%}, "
+        f"hits={speculative_stats['hits']}, misses={speculative_stats['misses']}, "
+        f"rendered={speculative_stats['rendered']}, wasted={speculative_stats['wasted']}, "
+        f"wasted_cpu={speculative_stats['wasted_cpu']:.2f}s, "
+        f"кэш {speculative_stats['bytes_cached']} байт)"
+    )
+
+
+def render_speculative_variant(source, darkness, position, logo_source, watermark_size):
+    """Отрендерить вариант в фоновом потоке → (JPEG, CPU-секунды).
+
+    Между этапами проверяем, не началась ли реальная работа; если да —
+    бросаем результат и возвращаем (None, потраченное CPU). Сам этап
+    (LANCZOS, JPEG) прервать нельзя.
+    """
+    started = time.thread_time()
+    if render_activity['active']:
+        return None, 0.0
+    img = darken_image(source, darkness)
+    if render_activity['active']:
+        return None, time.thread_time() - started
+    img = apply_logo(img, position, logo_source, watermark_size)
+    if render_activity['active']:
+        return None, time.thread_time() - started
+    data = encode_jpeg(img).getvalue()
+    return data, time.thread_time() - started
+
+
+def queue_speculative_job(user_id, job):
+    """Поставить задание в очередь фонового рендера (новое заменяет старое)"""
+    speculative_queue.pop(user_id, None)
+    speculative_queue[user_id] = job
+    while len(speculative_queue) > SPECULATIVE_QUEUE_MAX_USERS:
+        speculative_queue.popitem(last=False)
+
+
+async def render_speculative_job(loop, user_id, job):
+    """Отрендерить первый вариант задания; остальные вернуть в очередь"""
+    settings = get_user_settings(user_id)
+    # Фото или логотип сменились — варианты уже не нужны
+    if settings['last_image_id'] != job['image_id'] or settings['logo_digest'] != job['logo_digest']:
+        return
+    # Исходник берём из кэша только на время рендера; вытеснен — пропускаем
+    source = source_cache.get(job['image_id'])
+    if source is None:
+        return
+    
+    darkness, position, watermark_size = job['variants'][0]
+    key = get_variant_key(settings, darkness, position, watermark_size)
+    if key not in speculative_cache:
+        logo_source = BytesIO(settings['logo']) if settings['logo'] else DEFAULT_LOGO_PATH
+        data, cpu = await loop.run_in_executor(
+            speculative_executor,
+            render_speculative_variant,
+            source['image'], darkness, position, logo_source, watermark_size
+        )
+        source = None
+        
+        # Бюджет CPU: пауза, чтобы фон занимал не больше SPECULATIVE_CPU_SHARE
+        speculative_budget['next_allowed'] = time.monotonic() + cpu * (1 / SPECULATIVE_CPU_SHARE - 1)
+        
+        if data is None:
+            # Прервано реальной работой — повторим, если нет более нового задания
+            if cpu:
+                speculative_stats['wasted'] += 1
+                speculative_stats['wasted_cpu'] += cpu
+            if user_id not in speculative_queue:
+                queue_speculative_job(user_id, job)
+            return
+        
+        put_speculative_cache(key, {'data': data, 'cpu': cpu, 'used': False})
+        speculative_stats['rendered'] += 1
+    
+    rest = job['variants'][1:]
+    if not rest:
+        log_speculative_stats(f"готово для пользователя {user_id}")
+    elif user_id not in speculative_queue:
+        # В конец очереди — пользователи чередуются
+        queue_speculative_job(user_id, {**job, 'variants': rest})
+
+
+async def run_speculative_worker():
+    """Фоновый воркер: рендерит задания из очереди, пока бот свободен"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await speculative_wakeup.wait()
+        speculative_wakeup.clear()
+        # Началась реальная работа — ждём, пока обработчик разбудит снова
+        while speculative_queue and not render_activity['active']:
+            delay = speculative_budget['next_allowed'] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            user_id, job = speculative_queue.popitem(last=False)
+            try:
+                await render_speculative_job(loop, user_id, job)
+            except Exception as e:
+                logger.warning(f"Ошибка спекулятивного рендера для {user_id}: {e}")
+
+
+def schedule_speculative_render(user_id):
+    """Поставить вероятные следующие варианты последнего фото в фоновый рендер"""
+    if SPECULATIVE_CPU_SHARE <= 0:
+        return
+    settings = get_user_settings(user_id)
+    if settings['last_image_id'] is None:
+        return
+    variants = [
+        variant for variant in rank_speculative_variants(settings)
+        if get_variant_key(settings, *variant) not in speculative_cache
+    ]
+    if not variants:
+        return
+    queue_speculative_job(user_id, {
+        'image_id': settings['last_image_id'],
+        'logo_digest': settings['logo_digest'],
+        'variants': variants,
+    })
+    speculative_wakeup.set()
+
+
+def get_rendered_variant(user_id, settings):
+    """Фото с текущими настройками: из кэша спекулятивного рендера или рендер сейчас"""
+    key = get_variant_key(settings, settings['darkness'], settings['position'], settings['watermark_size'])
+    entry = speculative_cache.get(key)
+    if entry is not None:
+        speculative_cache.move_to_end(key)
+        entry['used'] = True
+        speculative_stats['hits'] += 1
+        log_speculative_stats(f"попадание для пользователя {user_id}")
+        return BytesIO(entry['data'])
+    
+    speculative_stats['misses'] += 1
+    log_speculative_stats(f"промах для пользователя {user_id}")
+    return render_last_image(user_id, settings)
+
+
 # ===== ОБРАБОТЧИКИ =====
 
+def serialize_per_user(handler):
+    """Обработчик, в котором обновления одного пользователя идут по очереди"""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with get_user_lock(update.effective_user.id):
+            await handler(update, context)
+    return wrapper
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     user_id = update.effective_user.id
@@ -262,6 +682,7 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     settings = get_user_settings(user_id)
     
+    render_activity['active'] += 1
     try:
         # Проверяем: это загрузка логотипа или обработка фото?
         if settings.get('waiting_for_logo', False):
@@ -272,6 +693,7 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # Сохраняем логотип
             settings['logo'] = bytes(logo_bytes)
+            settings['logo_digest'] = get_logo_digest(settings['logo'])
             settings['waiting_for_logo'] = False
             
             # Отправляем подтверждение
@@ -291,22 +713,15 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Уведомляем
         msg = await update.message.reply_text("⏳ Обрабатываю...")
         
-        # Скачиваем
-        file = await context.bot.get_file(photo.file_id)
-        photo_bytes = await file.download_as_bytearray()
+        # Скачиваем (или берём из кэша исходников)
+        source = await download_source(context.bot, photo)
         
         # Сохраняем оригинал
-        settings['last_image'] = bytes(photo_bytes)
+        settings['last_image'] = source['bytes']
+        settings['last_image_id'] = photo.file_unique_id
         
         # Обрабатываем
-        logo_source = get_user_logo(user_id)
-        output = process_image_with_settings(
-            photo_bytes,
-            settings['darkness'],
-            settings['position'],
-            logo_source,
-            logo_size_fraction=settings['watermark_size']
-        )
+        output = render_last_image(user_id, settings)
         
         # Удаляем "Обрабатываю..."
         await msg.delete()
@@ -329,9 +744,16 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         logger.info(f"Обработано фото от пользователя {user_id}")
         
+        # Пока пользователь смотрит на результат — готовим следующие варианты
+        schedule_speculative_render(user_id)
+        
     except Exception as e:
         logger.error(f"Ошибка обработки фото: {e}", exc_info=True)
         await update.message.reply_text(f"❌ Ошибка обработки: {str(e)}")
+    finally:
+        render_activity['active'] -= 1
+        if not render_activity['active']:
+            speculative_wakeup.set()
 
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -341,6 +763,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     settings = get_user_settings(user_id)
     data = query.data
     
+    render_activity['active'] += 1
     try:
         await query.answer()
         
@@ -430,6 +853,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # ===== СБРОС ЛОГОТИПА =====
         elif data == "reset_logo":
             settings['logo'] = None
+            settings['logo_digest'] = None
             
             with open(DEFAULT_LOGO_PATH, 'rb') as f:
                 logo_bytes = f.read()
@@ -485,17 +909,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif data.startswith("darkness_"):
             darkness = int(data.split("_")[1])
             settings['darkness'] = darkness
+            record_choice(settings, 'darkness', darkness)
             
             if settings['last_image']:
                 # Пересоздаём фото
-                logo_source = get_user_logo(user_id)
-                output = process_image_with_settings(
-                    settings['last_image'],
-                    settings['darkness'],
-                    settings['position'],
-                    logo_source,
-                    logo_size_fraction=settings['watermark_size']
-                )
+                output = get_rendered_variant(user_id, settings)
                 
                 caption = (
                     f"✅ <b>Затемнение: {'Без затемнения' if darkness == 0 else str(darkness) + '%'}</b>\n"
@@ -512,6 +930,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode='HTML',
                     reply_markup=get_settings_keyboard()
                 )
+                schedule_speculative_render(user_id)
             else:
                 # Просто обновляем настройки
                 text = (
@@ -531,16 +950,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             key = data.replace("wmsize_", "", 1)
             if key in WATERMARK_SIZE_FRACTIONS:
                 settings['watermark_size'] = WATERMARK_SIZE_FRACTIONS[key]
+                record_choice(settings, 'watermark_size', settings['watermark_size'])
                 size_label = get_watermark_size_label(settings['watermark_size'])
                 if settings['last_image']:
-                    logo_source = get_user_logo(user_id)
-                    output = process_image_with_settings(
-                        settings['last_image'],
-                        settings['darkness'],
-                        settings['position'],
-                        logo_source,
-                        logo_size_fraction=settings['watermark_size']
-                    )
+                    output = get_rendered_variant(user_id, settings)
                     caption = (
                         f"✅ <b>Размер ватермарки: {size_label}</b>\n"
                         f"Затемнение: {'Без затемнения' if settings['darkness'] == 0 else str(settings['darkness']) + '%'}\n"
@@ -555,6 +968,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         parse_mode='HTML',
                         reply_markup=get_settings_keyboard()
                     )
+                    schedule_speculative_render(user_id)
                 elif query.message.photo:
                     logo_bytes = get_logo_bytes(user_id)
                     caption = (
@@ -587,17 +1001,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif data.startswith("position_"):
             position = data.split("_", 1)[1]
             settings['position'] = position
+            record_choice(settings, 'position', position)
             
             if settings['last_image']:
                 # Пересоздаём фото
-                logo_source = get_user_logo(user_id)
-                output = process_image_with_settings(
-                    settings['last_image'],
-                    settings['darkness'],
-                    settings['position'],
-                    logo_source,
-                    logo_size_fraction=settings['watermark_size']
-                )
+                output = get_rendered_variant(user_id, settings)
                 
                 caption = (
                     f"✅ <b>Позиция: {get_position_label(position)}</b>\n"
@@ -614,6 +1022,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode='HTML',
                     reply_markup=get_settings_keyboard()
                 )
+                schedule_speculative_render(user_id)
             else:
                 # Просто обновляем настройки
                 text = (
@@ -651,6 +1060,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("❌ Ошибка. Попробуй /start", show_alert=True)
         except:
             pass
+    finally:
+        render_activity['active'] -= 1
+        if not render_activity['active']:
+            speculative_wakeup.set()
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -665,6 +1078,15 @@ async def post_init(application: Application):
     ]
     await application.bot.set_my_commands(commands)
     logger.info("✅ Команды бота установлены")
+    
+    speculative_worker['task'] = asyncio.create_task(run_speculative_worker())
+
+
+async def post_shutdown(application: Application):
+    """Остановка фонового рендера"""
+    if speculative_worker['task'] is not None:
+        speculative_worker['task'].cancel()
+    speculative_executor.shutdown(wait=False, cancel_futures=True)
 
 
 def main():
@@ -675,11 +1097,14 @@ def main():
     
     logger.info("🚀 Запуск Dox Image Bot v2.3 STABLE...")
     
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    # concurrent_updates: фото разных пользователей обрабатываются параллельно,
+    # одинаковые файлы качаются один раз (single-flight в download_source).
+    # Порядок обновлений одного пользователя сохраняет serialize_per_user
+    app = Application.builder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).concurrent_updates(True).build()
     
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.PHOTO, process_photo))
-    app.add_handler(CallbackQueryHandler(button_callback))
+    app.add_handler(CommandHandler("start", serialize_per_user(start)))
+    app.add_handler(MessageHandler(filters.PHOTO, serialize_per_user(process_photo)))
+    app.add_handler(CallbackQueryHandler(serialize_per_user(button_callback)))
     app.add_error_handler(error_handler)
     
     logger.info("✅ Бот запущен! Готов к работе...")